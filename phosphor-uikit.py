@@ -7,32 +7,69 @@
 import os
 import sys
 import json
+import re
 import shutil
-import urllib.request
+import base64
+import hashlib
+import time
+import threading
+import functools
+import itertools
 import subprocess
+import http.client
+import urllib.parse
+import urllib.request
+import concurrent.futures
 
 
 # Globals:
 
 flags = {
-    "--dry-run": False
+    "--dry-run": False,
+    "--refresh": False
 }
 
-valid_styles = set(["bold", "duotone", "fill", "light", "regular", "thin"])
+valid_styles = frozenset(["bold", "duotone", "fill", "light", "regular", "thin"])
 
-default_styles = set(["regular"])
-default_sizes = set([44])
+default_styles = frozenset(["regular"])
+default_sizes = frozenset([44])
 
 default_options = {
-    "renderer": "rsvg"
+    "renderer": "rsvg",
+    "downsample": False
 }
-valid_options = list(default_options.keys()) + ["phosphor_core_path", "enum_type_name", "enum_param_name"]
-valid_renderers = ["rsvg", "inkscape"]
+valid_options = frozenset(default_options.keys()) | frozenset(["phosphor_core_path", "enum_type_name", "enum_param_name"])
+valid_renderers = frozenset(["rsvg", "inkscape", "resvg", "cairosvg"])
 
 did_warn_bad_phosphor_core_path = False
 
+# The .xcassets Contents.json never changes, and neither does the "info" block which ends
+# every .imageset Contents.json, so they are pre-rendered (as json.dumps(..., indent=4) would).
+xcasset_contents_json = """{
+    "info": {
+        "author": "xcode",
+        "version": 1
+    }
+}
+"""
+imageset_contents_json_info = """    "info": {
+        "author": "xcode",
+        "version": 1
+    }
+}
+"""
+
+json_whitespace = re.compile(r"[ \t\n\r]*")
+
+svg_host = "raw.githubusercontent.com"
+svg_url_path = "/phosphor-icons/core/refs/heads/main/assets/%s/%s"
+svg_connections = threading.local()
+svg_fetch_attempts = 3
+svg_fetch_redirects = 10
+
 
 # Load a JSON config file.
+# Returns an iterator over the elements of the top-level array.
 def load_catalog_fpath(catalog_fpath):
     if not catalog_fpath.endswith(".json"):
         sys.stderr.write("❌ Error: config file does not have suffix '.json': %s\n" % catalog_fpath)
@@ -43,81 +80,154 @@ def load_catalog_fpath(catalog_fpath):
     except Exception as e:
         sys.stderr.write("❌ Error: unable to open file '%s': %s\n" % (catalog_fpath, repr(e)))
         sys.exit(1)
-    # Try to deserialize the file.
+    # Try to read the file.
     try:
-        config = json.load(fd)
+        text = fd.read()
         fd.close()
     except Exception as e:
         sys.stderr.write("❌ Error: unable to load file '%s': %s\n" % (catalog_fpath, repr(e)))
         sys.exit(1)
     # The top-level JSON element must be an array.
-    if type(config) is not list:
+    i = json_whitespace.match(text).end()
+    if not text.startswith("[", i):
+        # Deserialize the whole file to tell a malformed file from a non-array.
+        try:
+            json.loads(text)
+        except Exception as e:
+            sys.stderr.write("❌ Error: unable to load file '%s': %s\n" % (catalog_fpath, repr(e)))
+            sys.exit(1)
         sys.stderr.write("❌ Error: %s: top-level JSON element must be an array.\n" % catalog_fpath)
         sys.exit(1)
-    return config
+    return iter_config_elements(text, i + 1, catalog_fpath)
+
+
+# Incrementally deserialize the elements of the top-level JSON array, starting at offset i.
+# Each element is yielded as soon as it has been decoded, rather than building the whole array.
+def iter_config_elements(text, i, catalog_fpath):
+    decoder = json.JSONDecoder()
+    try:
+        i = json_whitespace.match(text, i).end()
+        if text.startswith("]", i):
+            i += 1
+        else:
+            while True:
+                (element, i) = decoder.raw_decode(text, i)
+                yield element
+                i = json_whitespace.match(text, i).end()
+                if text.startswith("]", i):
+                    i += 1
+                    break
+                if not text.startswith(",", i):
+                    raise json.JSONDecodeError("Expecting ',' delimiter", text, i)
+                i = json_whitespace.match(text, i + 1).end()
+        i = json_whitespace.match(text, i).end()
+        if i != len(text):
+            raise json.JSONDecodeError("Extra data", text, i)
+    except json.JSONDecodeError as e:
+        sys.stderr.write("❌ Error: unable to load file '%s': %s\n" % (catalog_fpath, repr(e)))
+        sys.exit(1)
 
 
-# Parse all of the options from the config object.
-def parse_options(config, catalog_fpath):
-    # First, look for config options.
+# Parse the options and icon groups from the config object, in a single pass.
+# Returns the options dict and a set of (icon name, size, style) triples, e.g.:
+# { ("person",44,"regular"), ("person",44,"bold") }
+def parse_config(config, catalog_fpath):
     options = default_options.copy()
+    icons_set = set()
     for e in config:
-        if type(e) is dict:
+        if isinstance(e, dict):
+            # This is a config option.
             for k, v in e.items():
                 # Is this a valid option name?
                 if k not in valid_options:
                     sys.stderr.write("❌ Error: %s: unknown option name '%s'.\n" % (catalog_fpath, k))
                     sys.exit(1)
                 options[k] = v
+        elif isinstance(e, list):
+            # This is an icon group.
+            parse_icon_group(e, catalog_fpath, icons_set)
+        # Anything else is a comment.  Skip.
     # Validate the config options.
     for k, v in options.items():
         if k == "renderer":
             if v not in valid_renderers:
                     sys.stderr.write("❌ Error: %s: unknown renderer '%s'.\n" % (catalog_fpath, v))
                     sys.exit(1)
-    return options
+            if v == "cairosvg":
+                try:
+                    import cairosvg
+                except (ImportError, OSError):
+                    # cairosvg raises OSError if the cairo library itself is missing.
+                    sys.stderr.write("❌ Error: %s: renderer 'cairosvg' requires CairoSVG and cairo (pip3 install cairosvg, brew install cairo).\n" % catalog_fpath)
+                    sys.exit(1)
+        elif k == "downsample":
+            if not isinstance(v, bool):
+                sys.stderr.write("❌ Error: %s: 'downsample' must be true or false.\n" % catalog_fpath)
+                sys.exit(1)
+            if v:
+                try:
+                    import PIL.Image
+                except ImportError:
+                    sys.stderr.write("❌ Error: %s: 'downsample' requires Pillow (pip3 install Pillow).\n" % catalog_fpath)
+                    sys.exit(1)
+    return (options, icons_set)
 
 
-# Parse out all of the icon groups from the config object.
-# Returns a set of (icon name, size, style) triples.:
-# { ("person",44,"regular"), ("person",44,"bold") }
-def parse_icon_groups(config, catalog_fpath):
-    icons_set = set()
-    for group in config:
-        if type(group) is not list:
-            # This is either a comment or a config option.  Skip.
-            continue
-        # Collect the names, sizes and styles in this group.
-        group_icon_names = set()
-        group_sizes = set()
-        group_styles = set()
-        for word in group:
-            if type(word) is int:
-                # This is a size.
-                group_sizes.add(word)
-            elif type(word) is str:
-                if word in valid_styles:
-                    # This is a style.
-                    group_styles.add(word)
-                else:
-                    # This is an icon name.
-                    group_icon_names.add(word)
+# Parse an icon group, adding its (icon name, size, style) triples to icons_set.
+def parse_icon_group(group, catalog_fpath, icons_set):
+    # Collect the names, sizes and styles in this group.
+    group_icon_names = set()
+    group_sizes = set()
+    group_styles = set()
+    styles = valid_styles
+    for word in group:
+        if isinstance(word, int) and not isinstance(word, bool):
+            # This is a size.
+            group_sizes.add(word)
+        elif isinstance(word, str):
+            if word in styles:
+                # This is a style.
+                group_styles.add(word)
             else:
-                # Unrecognized junk in this group.
-                sys.stderr.write("❌ Error: %s: unexpected value '%s'.\n" % (catalog_fpath, word))
-                sys.exit(1)
-        # If we didn't find any sizes or styles, use the defaults.
-        if len(group_sizes) == 0:
-            group_sizes = default_sizes.copy()
-        if len(group_styles) == 0:
-            group_styles = default_styles.copy()
-        # Do the combinatorial explosion and add them to the set.
-        for name in group_icon_names:
-            for size in group_sizes:
-                for style in group_styles:
-                    triple = (name, size, style)
-                    icons_set.add(triple)
-    return icons_set
+                # This is an icon name.
+                group_icon_names.add(word)
+        else:
+            # Unrecognized junk in this group.
+            sys.stderr.write("❌ Error: %s: unexpected value '%s'.\n" % (catalog_fpath, word))
+            sys.exit(1)
+    # If we didn't find any sizes or styles, use the defaults.
+    if len(group_sizes) == 0:
+        group_sizes = default_sizes
+    if len(group_styles) == 0:
+        group_styles = default_styles
+    # Do the combinatorial explosion and add them to the set.
+    icons_set.update(itertools.product(group_icon_names, group_sizes, group_styles))
+
+
+# Return a temporary path alongside fpath, unique to this process and thread.
+def tmp_fpath_for(fpath):
+    return "%s.%s.%s.tmp" % (fpath, os.getpid(), threading.get_ident())
+
+
+# Remove a temporary file left behind by a failed write, if there is one.
+def remove_tmp_fpath(tmp_fpath):
+    try:
+        os.remove(tmp_fpath)
+    except FileNotFoundError:
+        pass
+
+
+# Write a text file atomically, by writing to a temporary file and renaming it into place.
+# Readers (and concurrent runs) never see a partially-written file.
+def write_file_atomically(fpath, text):
+    tmp_fpath = tmp_fpath_for(fpath)
+    try:
+        with open(tmp_fpath, "w") as fd:
+            fd.write(text)
+        os.replace(tmp_fpath, fpath)
+    except BaseException:
+        remove_tmp_fpath(tmp_fpath)
+        raise
 
 
 # Generate a .xcassets Contents.json file.
@@ -132,12 +242,9 @@ def make_xcasset_contents_json(catalog_dpath):
     # Ensure the top-level Contents.json exists.
     fpath = catalog_dpath + "/Contents.json"
     if not os.path.exists(fpath):
-        d = {"info": {"author": "xcode", "version": 1}}
-        j = json.dumps(d, sort_keys=True, indent=4, separators=(',', ': ')) + "\n"
         sys.stdout.write("⚙️  Creating 📄 %s\n" % fpath)
         if not flags["--dry-run"]:
-            with open(fpath, "w+") as fd:
-                fd.write(j)
+            write_file_atomically(fpath, xcasset_contents_json)
 
 
 # Generate a .imageset Contents.json file.
@@ -165,31 +272,36 @@ def make_xcasset_contents_json(catalog_dpath):
 #     "version" : 1
 #   }
 # }
-def make_imageset_contents_json(imageset_dpath, png_fnames):
-    contents = {"info": {"author": "xcode", "version": 1}, "images": []}
-    for png_fname in png_fnames:
-        if "@3x" in png_fname:
-            scale = "3x"
-        elif "@2x" in png_fname:
-            scale = "2x"
-        else:
-            scale = "1x"
-        d = {
-            "filename": png_fname,
-            "idiom": "universal",
-            "scale": scale
-        }
-        contents["images"].append(d)
+# contents_exists says whether the imageset already has a Contents.json.
+# Status lines are appended to log.
+# Only the "images" array is serialized, the constant "info" block is spliced in after it.
+def make_imageset_contents_json(imageset_dpath, png_fnames, contents_exists, log):
     fpath = imageset_dpath + "/Contents.json"
-    if not os.path.exists(fpath):
-        j = json.dumps(contents, sort_keys=True, indent=4, separators=(',', ': ')) + "\n"
-        sys.stdout.write("⚙️  Creating 📄 %s\n" % fpath)
+    if not contents_exists:
+        images = []
+        for png_fname in png_fnames:
+            if "@3x" in png_fname:
+                scale = "3x"
+            elif "@2x" in png_fname:
+                scale = "2x"
+            else:
+                scale = "1x"
+            d = {
+                "filename": png_fname,
+                "idiom": "universal",
+                "scale": scale
+            }
+            images.append(d)
+        j = json.dumps(images, sort_keys=True, indent=4, separators=(',', ': '))
+        # Indent the array to sit inside the top-level object.
+        j = '{\n    "images": ' + j.replace("\n", "\n    ") + ",\n" + imageset_contents_json_info
+        log.append("⚙️  Creating 📄 %s\n" % fpath)
         if not flags["--dry-run"]:
-            with open(fpath, "w+") as fd:
-                fd.write(j)
+            write_file_atomically(fpath, j)
 
 
 # Construct an SVG filename, given an icon name and style.
+@functools.lru_cache(maxsize=None)
 def svg_fname(name, style):
     if style == "regular":
         fname = "%s.svg" % name
@@ -198,18 +310,26 @@ def svg_fname(name, style):
     return fname
 
 
+# Return the path to an SVG file in a phosphor checkout, or None if it isn't there.
+# The checkout doesn't change during a run, so the lookups are memoized.
+@functools.lru_cache(maxsize=None)
+def checkout_svg_fpath(phosphor_core_path, name, style):
+    checkout_path = os.path.expanduser(phosphor_core_path)
+    fpath = checkout_path + "/assets/%s/%s" % (style, svg_fname(name, style))
+    if os.path.exists(fpath):
+        return fpath
+    return None
+
+
 # If we have a phosphor checkout, use that.
 # If we have local HTTP cache, use that.
-# Otherwise, fetch the SVG from github.
-# In any case, return the path to the SVG file.
-def get_svg_fpath(name, style, options):
+# Return the path to the SVG file, or None if it isn't available locally.
+def find_svg_fpath(name, style, options):
     global did_warn_bad_phosphor_core_path
     fname = svg_fname(name, style)
     if "phosphor_core_path" in options and not did_warn_bad_phosphor_core_path:
-        checkout_path = os.path.expanduser(options["phosphor_core_path"])
-        dpath = checkout_path + "/assets/%s" % style
-        fpath = "%s/%s" % (dpath, fname)
-        if os.path.exists(fpath):
+        fpath = checkout_svg_fpath(options["phosphor_core_path"], name, style)
+        if fpath is not None:
             return fpath
         else:
             if not did_warn_bad_phosphor_core_path:
@@ -217,48 +337,476 @@ def get_svg_fpath(name, style, options):
                 did_warn_bad_phosphor_core_path = True
     # Local checkout didn't work, try HTTP cache.
     cache_path = os.path.expanduser("~/.phosphor-uikit/svg-cache")
-    dpath = cache_path + "/assets/%s" % style
-    fpath = "%s/%s" % (dpath, fname)
+    fpath = cache_path + "/assets/%s/%s" % (style, fname)
     if os.path.exists(fpath):
         return fpath
-    # No HTTP cache, fetch the SVG and cache it.
-    if not os.path.exists(dpath):
-        sys.stdout.write("⚙️  Creating 📁 %s\n" % dpath)
-        if not flags["--dry-run"]:
-            os.makedirs(dpath, exist_ok=True)
-    url = "https://raw.githubusercontent.com/phosphor-icons/core/refs/heads/main/assets/%s/%s" % (style, fname)
-    sys.stdout.write("🛜 Fetching 🏞️  %s\n" % url)
-    if not flags["--dry-run"]:
-        urllib.request.urlretrieve(url, fpath)
-    return fpath
+    return None
+
+
+# Locate the SVG files for a set of (icon name, style) pairs.
+# SVG's which are available locally are used as-is, the rest need to be fetched from github.
+# With --refresh, SVG's in the HTTP cache are re-validated against github.
+# Returns a dict of (icon name, style) -> SVG path, and a list of (URL path, SVG path) fetches.
+def locate_svgs(name_style_pairs, options):
+    svg_fpaths = {}
+    fetches = []
+    cache_path = os.path.expanduser("~/.phosphor-uikit/svg-cache")
+    for (name, style) in sorted(name_style_pairs):
+        fpath = find_svg_fpath(name, style, options)
+        fname = svg_fname(name, style)
+        if fpath is None:
+            # No HTTP cache, fetch the SVG and cache it.
+            fpath = cache_path + "/assets/%s/%s" % (style, fname)
+            fetches.append((svg_url_path % (style, fname), fpath))
+        elif flags["--refresh"] and fpath.startswith(cache_path + "/"):
+            fetches.append((svg_url_path % (style, fname), fpath))
+        svg_fpaths[(name, style)] = fpath
+    return (svg_fpaths, fetches)
+
+
+# Start fetching SVG files from github, in the background.
+# fetches is a list of (URL path, SVG path) pairs.
+# Returns a dict of future -> SVG path, one per fetch.
+def start_svg_fetches(fetches, executor):
+    for dpath in sorted(set([os.path.dirname(fpath) for (url_path, fpath) in fetches])):
+        if not os.path.exists(dpath):
+            sys.stdout.write("⚙️  Creating 📁 %s\n" % dpath)
+            if not flags["--dry-run"]:
+                os.makedirs(dpath, exist_ok=True)
+    for (url_path, fpath) in fetches:
+        if os.path.exists(fpath):
+            sys.stdout.write("🛜 Refreshing 🏞️  https://%s%s\n" % (svg_host, url_path))
+        else:
+            sys.stdout.write("🛜 Fetching 🏞️  https://%s%s\n" % (svg_host, url_path))
+    if flags["--dry-run"]:
+        return {}
+    return {executor.submit(fetch_svg, url_path, fpath): fpath for (url_path, fpath) in fetches}
+
+
+# Open an HTTPS connection to host, tunnelled through the HTTPS proxy if one is configured
+# (e.g. via $https_proxy), as urllib would.
+def open_https_connection(host):
+    proxy = urllib.request.getproxies().get("https")
+    if proxy is None or urllib.request.proxy_bypass(host):
+        return http.client.HTTPSConnection(host, timeout=30)
+    if "://" not in proxy:
+        proxy = "http://" + proxy
+    proxy_url = urllib.parse.urlsplit(proxy)
+    headers = {}
+    if proxy_url.username is not None:
+        credentials = "%s:%s" % (urllib.parse.unquote(proxy_url.username), urllib.parse.unquote(proxy_url.password or ""))
+        headers["Proxy-Authorization"] = "Basic " + base64.b64encode(credentials.encode()).decode()
+    connection = http.client.HTTPSConnection(proxy_url.hostname, proxy_url.port, timeout=30)
+    connection.set_tunnel(host, headers=headers)
+    return connection
+
+
+# Fetch an SVG file from github into the HTTP cache.
+# Each worker thread re-uses a keep-alive HTTPS connection per host for all of its fetches.
+# If the SVG is already cached, it is only re-fetched if its ETag has changed.
+# Connection errors and 5xx responses are retried, with exponential backoff.
+# Redirects are followed (up to svg_fetch_redirects of them).
+def fetch_svg(url_path, fpath):
+    url = "https://%s%s" % (svg_host, url_path)
+    (host, path) = (svg_host, url_path)
+    headers = {}
+    etag_fpath = fpath + ".etag"
+    if os.path.exists(fpath) and os.path.exists(etag_fpath):
+        with open(etag_fpath) as fd:
+            headers["If-None-Match"] = fd.read()
+    if not hasattr(svg_connections, "by_host"):
+        svg_connections.by_host = {}
+    attempt = 0
+    redirects = 0
+    while True:
+        if host not in svg_connections.by_host:
+            svg_connections.by_host[host] = open_https_connection(host)
+        connection = svg_connections.by_host[host]
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            if response.status == 200:
+                # Stream to a temporary file, so that an interrupted fetch never lands in the cache.
+                tmp_fpath = tmp_fpath_for(fpath)
+                try:
+                    with open(tmp_fpath, "wb") as fd:
+                        shutil.copyfileobj(response, fd)
+                    os.replace(tmp_fpath, fpath)
+                except BaseException:
+                    remove_tmp_fpath(tmp_fpath)
+                    raise
+                etag = response.getheader("ETag")
+                if etag is not None:
+                    write_file_atomically(etag_fpath, etag)
+                else:
+                    # Don't re-validate the new SVG against the old SVG's ETag.
+                    try:
+                        os.remove(etag_fpath)
+                    except FileNotFoundError:
+                        pass
+                return
+            # Drain the body, so that the connection can be re-used.
+            response.read()
+        except (OSError, http.client.HTTPException) as e:
+            # The connection is in an unknown state, so start afresh.
+            connection.close()
+            del svg_connections.by_host[host]
+            error = repr(e)
+        else:
+            if response.status == 304:
+                # Not modified.  Leave the cached SVG (and its mtime) alone.
+                return
+            location = response.getheader("Location")
+            if response.status in (301, 302, 303, 307, 308) and location is not None:
+                redirect_url = urllib.parse.urlsplit(urllib.parse.urljoin("https://%s%s" % (host, path), location))
+                if redirects == svg_fetch_redirects:
+                    error = "too many redirects"
+                    break
+                if redirect_url.scheme != "https":
+                    error = "redirected to %s" % redirect_url.geturl()
+                    break
+                redirects += 1
+                host = redirect_url.netloc
+                path = urllib.parse.urlunsplit(("", "", redirect_url.path or "/", redirect_url.query, ""))
+                continue
+            error = "HTTP %s" % response.status
+            if response.status < 500:
+                # Retrying won't help.
+                break
+        attempt += 1
+        if attempt == svg_fetch_attempts:
+            break
+        time.sleep(2 ** (attempt - 1))
+    sys.stderr.write("❌ Error: unable to fetch %s: %s\n" % (url, error))
+    sys.exit(1)
 
 
 # Rasterize a PNG, using the configured raster program.
-def rasterize(name, size, style, png_fpath, options):
-    resolution = size
-    if "@2x" in png_fpath:
-        resolution = size * 2
-    elif "@3x" in png_fpath:
-        resolution = size * 3
-    svg_fpath = get_svg_fpath(name, style, options)
-    rasterize_rsvg(name, style, resolution, svg_fpath, png_fpath, options)
+# A job is a (name, style, resolution, svg_fpath, png_fpath) tuple.
+# (Inkscape is rendered in batches instead, see rasterize_inkscape_batches().)
+def rasterize(job, options):
+    (name, style, resolution, svg_fpath, png_fpath) = job
+    if options["renderer"] == "resvg":
+        rasterize_resvg(name, style, resolution, svg_fpath, png_fpath, options)
+    elif options["renderer"] == "cairosvg":
+        rasterize_cairosvg(name, style, resolution, svg_fpath, png_fpath, options)
+    else:
+        rasterize_rsvg(name, style, resolution, svg_fpath, png_fpath, options)
+
+
+# Return the path to the PNG cache entry for an SVG rendered at a given resolution.
+# Entries are keyed by the SVG's content, so identical SVG's share a single rendering.
+# Entries downsampled from a higher resolution also record the source resolution.
+def png_cache_fpath(svg_digest, resolution, options, source_resolution=None):
+    cache_path = os.path.expanduser("~/.phosphor-uikit/png-cache")
+    if source_resolution is not None:
+        return "%s/%s.%s.from-%s.%s.png" % (cache_path, svg_digest, resolution, source_resolution, options["renderer"])
+    return "%s/%s.%s.%s.png" % (cache_path, svg_digest, resolution, options["renderer"])
+
+
+# Return the scale (1, 2 or 3) of a PNG, based on its filename.
+def png_scale(png_fpath):
+    if "@3x" in png_fpath:
+        return 3
+    elif "@2x" in png_fpath:
+        return 2
+    else:
+        return 1
+
+
+# Plan how to fill the PNG cache for a list of jobs.
+# Returns a dict of PNG cache path -> (render job, PNG paths, downsamples), where the render
+# job is None if the cache entry already exists.  Each missing entry is only rendered once.
+# With the 'downsample' option, only the @3x PNG's are rendered and the @2x and @1x PNG's
+# are downsampled from them.  downsamples is a dict of PNG cache path -> (downsample job,
+# PNG paths), where a downsample job is a (resolution, temporary PNG path) pair, or None
+# if that cache entry already exists.
+def plan_png_cache(jobs, options):
+    plan = {}
+    svg_digests = {}
+    for (name, style, resolution, svg_fpath, png_fpath) in jobs:
+        if svg_fpath not in svg_digests:
+            with open(svg_fpath, "rb") as fd:
+                svg_digests[svg_fpath] = hashlib.sha256(fd.read()).hexdigest()
+        source_resolution = resolution
+        if options["downsample"]:
+            source_resolution = resolution * 3 // png_scale(png_fpath)
+        source_cache_fpath = png_cache_fpath(svg_digests[svg_fpath], source_resolution, options)
+        if source_cache_fpath not in plan:
+            render_job = None
+            if not os.path.exists(source_cache_fpath):
+                # Render to a temporary file, so that an interrupted render never lands in the cache.
+                # (Keep the .png suffix, as inkscape uses it to pick the export type.)
+                tmp_fpath = tmp_fpath_for(source_cache_fpath) + ".png"
+                render_job = (name, style, source_resolution, svg_fpath, tmp_fpath)
+            plan[source_cache_fpath] = (render_job, [], {})
+        if source_resolution == resolution:
+            plan[source_cache_fpath][1].append(png_fpath)
+            continue
+        downsamples = plan[source_cache_fpath][2]
+        cache_fpath = png_cache_fpath(svg_digests[svg_fpath], resolution, options, source_resolution)
+        if cache_fpath not in downsamples:
+            downsample_job = None
+            if not os.path.exists(cache_fpath):
+                downsample_job = (resolution, tmp_fpath_for(cache_fpath) + ".png")
+            downsamples[cache_fpath] = (downsample_job, [])
+        downsamples[cache_fpath][1].append(png_fpath)
+    return plan
+
+
+# Move a freshly rendered PNG into the cache, make any PNG's which are downsampled from it,
+# then link the cache entries into the asset catalog.
+def store_cached_png(cache_fpath, render_job, png_fpaths, downsamples):
+    if render_job is not None:
+        try:
+            os.replace(render_job[4], cache_fpath)
+        except BaseException:
+            remove_tmp_fpath(render_job[4])
+            raise
+    for png_fpath in png_fpaths:
+        link_cached_png(cache_fpath, png_fpath)
+    for (downsample_cache_fpath, (downsample_job, downsample_png_fpaths)) in downsamples.items():
+        if downsample_job is not None:
+            (resolution, tmp_fpath) = downsample_job
+            try:
+                downsample_png(cache_fpath, resolution, tmp_fpath)
+                os.replace(tmp_fpath, downsample_cache_fpath)
+            except BaseException:
+                remove_tmp_fpath(tmp_fpath)
+                raise
+        for png_fpath in downsample_png_fpaths:
+            link_cached_png(downsample_cache_fpath, png_fpath)
+
+
+# Downsample a square PNG to the given resolution, using Pillow.
+# Parsing and rendering the SVG dominates, so a Lanczos resample is much cheaper than a re-render.
+def downsample_png(source_fpath, resolution, png_fpath):
+    import PIL.Image
+    try:
+        with PIL.Image.open(source_fpath) as image:
+            (width, height) = image.size
+            factor = resolution / max(width, height)
+            size = (max(1, round(width * factor)), max(1, round(height * factor)))
+            image.resize(size, PIL.Image.LANCZOS).save(png_fpath, "PNG")
+    except Exception as e:
+        sys.stderr.write("❌ Error: unable to downsample %s: %s\n" % (source_fpath, repr(e)))
+        sys.exit(1)
+
+
+# Hard-link a cached PNG into place, falling back to a copy (e.g. across filesystems).
+# The PNG is linked under a temporary name and renamed into place, replacing any stale PNG,
+# so that the asset catalog never contains a partial PNG.
+def link_cached_png(cache_fpath, png_fpath):
+    if os.path.exists(png_fpath) and os.path.samefile(cache_fpath, png_fpath):
+        # Already linked (e.g. the SVG was touched but not changed).  Just mark it as up-to-date.
+        # (Renaming a link over another link to the same file would be a no-op.)
+        os.utime(png_fpath)
+        return
+    tmp_fpath = tmp_fpath_for(png_fpath)
+    try:
+        try:
+            os.link(cache_fpath, tmp_fpath)
+        except OSError:
+            shutil.copyfile(cache_fpath, tmp_fpath)
+        # The cache entry may predate the SVG (e.g. the SVG was touched but not changed),
+        # so bump the mtime to mark the PNG as up-to-date.
+        os.utime(tmp_fpath)
+        os.replace(tmp_fpath, png_fpath)
+    except BaseException:
+        remove_tmp_fpath(tmp_fpath)
+        raise
+
+
+# Rasterize all of the PNG's, running the raster program in parallel.
+# The raster program does the heavy lifting in a subprocess, so a thread pool is sufficient.
+# Renderings are stored in the PNG cache and then linked into the asset catalog.
+# fetch_futures are the outstanding SVG fetches (future -> SVG path).  The PNG's for each
+# SVG are handed to the raster program as soon as that SVG arrives, so rasterization
+# overlaps with fetching.
+def rasterize_all(jobs, fetch_futures, options):
+    sys.stdout.write("".join(["⚙️  Creating 🏞️  %s\n" % job[4] for job in jobs]))
+    if flags["--dry-run"] or len(jobs) == 0:
+        return
+    cache_path = os.path.expanduser("~/.phosphor-uikit/png-cache")
+    if not os.path.exists(cache_path):
+        sys.stdout.write("⚙️  Creating 📁 %s\n" % cache_path)
+        os.makedirs(cache_path, exist_ok=True)
+    if options["renderer"] == "inkscape":
+        # Inkscape is rendered in batches, so wait for all of the SVG's first.
+        for fetch_future in concurrent.futures.as_completed(fetch_futures):
+            fetch_future.result()
+        plan = plan_png_cache(jobs, options)
+        render_jobs = [render_job for (render_job, png_fpaths, downsamples) in plan.values() if render_job is not None]
+        try:
+            rasterize_inkscape_batches(render_jobs, options)
+        except BaseException:
+            for render_job in render_jobs:
+                remove_tmp_fpath(render_job[4])
+            raise
+        for (cache_fpath, (render_job, png_fpaths, downsamples)) in plan.items():
+            store_cached_png(cache_fpath, render_job, png_fpaths, downsamples)
+        return
+    jobs_by_svg_fpath = {}
+    for job in jobs:
+        jobs_by_svg_fpath.setdefault(job[3], []).append(job)
+
+    # Set as soon as any render fails, so that the renders already queued are skipped.
+    failed = threading.Event()
+
+    # Wait for any cache entries which another task is filling in, then render and link.
+    def render(cache_fpath, render_job, png_fpaths, downsamples, waits):
+        if failed.is_set():
+            return
+        try:
+            for wait_future in waits:
+                wait_future.result()
+            if render_job is not None:
+                try:
+                    rasterize(render_job, options)
+                except BaseException:
+                    remove_tmp_fpath(render_job[4])
+                    raise
+            store_cached_png(cache_fpath, render_job, png_fpaths, downsamples)
+        except BaseException:
+            failed.set()
+            raise
+
+    max_workers = os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        render_futures = []
+        # PNG cache path -> the future which fills in that cache entry.  Identical SVG's (e.g.
+        # different icons with the same artwork) share cache entries, so only the first task
+        # renders (or downsamples) an entry and the others wait for it and then just link.
+        # (The waited-on task was submitted first, so it is never stuck in the queue behind us.)
+        in_flight = {}
+
+        def submit(svg_fpath):
+            plan = plan_png_cache(jobs_by_svg_fpath.get(svg_fpath, []), options)
+            for (cache_fpath, (render_job, png_fpaths, downsamples)) in plan.items():
+                waits = []
+                if cache_fpath in in_flight:
+                    waits.append(in_flight[cache_fpath])
+                    render_job = None
+                task_downsamples = {}
+                for (downsample_cache_fpath, (downsample_job, downsample_png_fpaths)) in downsamples.items():
+                    if downsample_cache_fpath in in_flight:
+                        waits.append(in_flight[downsample_cache_fpath])
+                        downsample_job = None
+                    task_downsamples[downsample_cache_fpath] = (downsample_job, downsample_png_fpaths)
+                render_future = executor.submit(render, cache_fpath, render_job, png_fpaths, task_downsamples, waits)
+                for fpath in [cache_fpath] + list(task_downsamples.keys()):
+                    in_flight.setdefault(fpath, render_future)
+                render_futures.append(render_future)
+
+        try:
+            # Start with the SVG's which are already on disk, then take the rest as they arrive.
+            fetching_svg_fpaths = set(fetch_futures.values())
+            for svg_fpath in jobs_by_svg_fpath:
+                if svg_fpath not in fetching_svg_fpaths:
+                    submit(svg_fpath)
+            for fetch_future in concurrent.futures.as_completed(fetch_futures):
+                if failed.is_set():
+                    break
+                fetch_future.result()
+                submit(fetch_futures[fetch_future])
+            for render_future in concurrent.futures.as_completed(render_futures):
+                render_future.result()
+        except BaseException:
+            # Stop at the first error, rather than running every queued render (or fetch) on shutdown.
+            executor.shutdown(wait=False, cancel_futures=True)
+            for fetch_future in fetch_futures:
+                fetch_future.cancel()
+            raise
+
+
+# Rasterize a list of jobs using inkscape, in parallel.
+# Inkscape is slow to start, so each worker's share of the jobs is fed
+# to a single long-lived inkscape process.
+def rasterize_inkscape_batches(jobs, options):
+    max_workers = os.cpu_count() or 1
+    batches = [jobs[i::max_workers] for i in range(max_workers)]
+    batches = [batch for batch in batches if len(batch) > 0]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(rasterize_inkscape_batch, batch, options) for batch in batches]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except BaseException:
+            # Stop at the first error, rather than running every queued batch on shutdown.
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
 
 
 # Rasterize a PNG, using librsvg.
 def rasterize_rsvg(name, style, resolution, svg_fpath, png_fpath, options):
-    cmd = "rsvg-convert"
-    cmd += " --width=%s" % resolution
-    cmd += " --height=%s" % resolution
-    cmd += " --keep-aspect-ratio"
-    cmd += " %s" % svg_fpath
-    cmd += " > %s" % png_fpath
-    sys.stdout.write("⚙️  Creating 🏞️  %s\n" % png_fpath)
-    if not flags["--dry-run"]:
-        try:
-            subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
-        except subprocess.CalledProcessError as e:
-            sys.stderr.write("❌ Error: rsvg-convert failed:\n")
-            sys.stderr.write(e.output.decode())
+    cmd = ["rsvg-convert"]
+    cmd += ["--width=%s" % resolution]
+    cmd += ["--height=%s" % resolution]
+    cmd += ["--keep-aspect-ratio"]
+    cmd += ["--output=%s" % png_fpath]
+    cmd += [svg_fpath]
+    try:
+        subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
+    except FileNotFoundError:
+        sys.stderr.write("❌ Error: rsvg-convert not found.\n")
+        sys.exit(1)
+    except subprocess.CalledProcessError as e:
+        sys.stderr.write("❌ Error: rsvg-convert failed:\n")
+        sys.stderr.write(e.output.decode())
+        sys.exit(1)
+
+
+# Rasterize a PNG, using resvg.
+# resvg starts quickly and is fast on small SVG's like the Phosphor icons.
+def rasterize_resvg(name, style, resolution, svg_fpath, png_fpath, options):
+    cmd = ["resvg", "-w", str(resolution), "-h", str(resolution), svg_fpath, png_fpath]
+    try:
+        subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
+    except FileNotFoundError:
+        sys.stderr.write("❌ Error: resvg not found.\n")
+        sys.exit(1)
+    except subprocess.CalledProcessError as e:
+        sys.stderr.write("❌ Error: resvg failed:\n")
+        sys.stderr.write(e.output.decode())
+        sys.exit(1)
+
+
+# Rasterize a PNG in-process, using CairoSVG.
+# This avoids starting a process per PNG.  (CairoSVG parses the SVG in Python, holding the GIL,
+# so the thread pool mostly runs one of these renders at a time.)
+def rasterize_cairosvg(name, style, resolution, svg_fpath, png_fpath, options):
+    import cairosvg
+    try:
+        cairosvg.svg2png(url=svg_fpath, write_to=png_fpath, output_width=resolution, output_height=resolution)
+    except Exception as e:
+        sys.stderr.write("❌ Error: cairosvg failed to render %s: %s\n" % (svg_fpath, repr(e)))
+        sys.exit(1)
+
+
+# Rasterize a batch of PNG's, using a single "inkscape --shell" process.
+def rasterize_inkscape_batch(jobs, options):
+    script = ""
+    for (name, style, resolution, svg_fpath, png_fpath) in jobs:
+        script += "file-open:%s;" % svg_fpath
+        script += " export-filename:%s;" % png_fpath
+        script += " export-width:%s;" % resolution
+        script += " export-height:%s;" % resolution
+        script += " export-do;"
+        script += " file-close\n"
+    script += "quit\n"
+    try:
+        subprocess.run(["inkscape", "--shell"], input=script.encode(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
+    except FileNotFoundError:
+        sys.stderr.write("❌ Error: inkscape not found.\n")
+        sys.exit(1)
+    except subprocess.CalledProcessError as e:
+        sys.stderr.write("❌ Error: inkscape failed:\n")
+        sys.stderr.write(e.output.decode())
+        sys.exit(1)
+    # inkscape --shell doesn't report export failures via its exit status.
+    for (name, style, resolution, svg_fpath, png_fpath) in jobs:
+        if not os.path.exists(png_fpath):
+            sys.stderr.write("❌ Error: inkscape failed to create %s\n" % png_fpath)
             sys.exit(1)
 
 
@@ -348,8 +896,13 @@ extension UIImage {
     fpath = os.path.join(dname, fname)
     sys.stdout.write("⚙️  Creating 📄 %s\n" % fpath)
     if not flags["--dry-run"]:
-        with open(fpath, "w+") as fd:
-            fd.write(code)
+        write_file_atomically(fpath, code)
+
+
+# Return the .imageset dirname and the 1x, 2x and 3x PNG filenames for an icon.
+def imageset_fnames(name, size, style):
+    base = "%s.%s.%s" % (name, size, style)
+    return (base + ".imageset", base + ".png", base + "@2x.png", base + "@3x.png")
 
 
 # Generate or update an asset catalog.
@@ -363,15 +916,16 @@ def update_asset_catalog(catalog_dpath, icons_set, options):
     make_xcasset_contents_json(catalog_dpath)
     # First, reconcile the .imageset directories.
     existing_imageset_dnames = set()
-    if os.path.exists(catalog_dpath):
-        for dname in os.listdir(catalog_dpath):
-            dpath = os.path.join(catalog_dpath, dname)
-            if dname.endswith(".imageset"):
-                existing_imageset_dnames.add(dname)
-    expected_imageset_dnames = set()
-    for (name, size, style) in icons_set:
-        imageset_dname = "%s.%s.%s.imageset" % (name, size, style)
-        expected_imageset_dnames.add(imageset_dname)
+    try:
+        with os.scandir(catalog_dpath) as entries:
+            for entry in entries:
+                if entry.name.endswith(".imageset") and entry.is_dir():
+                    existing_imageset_dnames.add(entry.name)
+    except FileNotFoundError:
+        # This is a dry run and the .xcassets directory hasn't been created.
+        pass
+    icons_fnames = {icon: imageset_fnames(*icon) for icon in icons_set}
+    expected_imageset_dnames = {fnames[0] for fnames in icons_fnames.values()}
     # Create the plan.
     imagesets_to_create = expected_imageset_dnames.difference(existing_imageset_dnames)
     imagesets_to_delete = existing_imageset_dnames.difference(expected_imageset_dnames)
@@ -387,40 +941,83 @@ def update_asset_catalog(catalog_dpath, icons_set, options):
         if not flags["--dry-run"]:
             os.mkdir(dpath)
     # Next, reconcile the png's within each imageset.
+    svg_fpaths = {}
+    if flags["--refresh"]:
+        # Re-validate all of the cached SVG's up front, so that any changed SVG's mark their PNG's as stale.
+        (svg_fpaths, fetches) = locate_svgs(set([(name, style) for (name, size, style) in icons_set]), options)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as fetch_executor:
+            try:
+                for fetch_future in concurrent.futures.as_completed(start_svg_fetches(fetches, fetch_executor)):
+                    fetch_future.result()
+            except BaseException:
+                # Stop at the first error, rather than running every queued fetch on shutdown.
+                fetch_executor.shutdown(wait=False, cancel_futures=True)
+                raise
+    pending_jobs = []
+    svg_mtimes = {}
+    # Buffer the status lines and write them out in one go after the loop.
+    log = []
     for (name, size, style) in sorted(icons_set):
-        existing_png_fnames = set()
-        imageset_dname = "%s.%s.%s.imageset" % (name, size, style)
+        (imageset_dname, fname1x, fname2x, fname3x) = icons_fnames[(name, size, style)]
         dpath = os.path.join(catalog_dpath, imageset_dname)
-        if os.path.exists(dpath):
-            for fname in os.listdir(dpath):
-                if fname.endswith(".png"):
-                    existing_png_fnames.add(fname)
-        expected_png_fnames = set()
-        fname1x = "%s.%s.%s.png" % (name, size, style)
-        fname2x = "%s.%s.%s@2x.png" % (name, size, style)
-        fname3x = "%s.%s.%s@3x.png" % (name, size, style)
-        expected_png_fnames.update([fname1x, fname2x, fname3x])
+        # Scan the imageset once, and re-use the entries for everything below.
+        try:
+            with os.scandir(dpath) as it:
+                entries = {entry.name: entry for entry in it}
+        except FileNotFoundError:
+            # This is a dry run and the .imageset directory hasn't been created.
+            entries = {}
+        existing_png_fnames = {fname for (fname, entry) in entries.items() if fname.endswith(".png") and entry.is_file()}
+        expected_png_fnames = set([fname1x, fname2x, fname3x])
         # Create the plan.
         pngs_to_create = expected_png_fnames.difference(existing_png_fnames)
         pngs_to_delete = existing_png_fnames.difference(expected_png_fnames)
+        # Existing PNG's which are older than their SVG are stale and need to be re-created.
+        pngs_to_check = expected_png_fnames.intersection(existing_png_fnames)
+        if len(pngs_to_check) > 0:
+            if (name, style) not in svg_mtimes:
+                # The icon's sizes all share one SVG.  If it isn't available locally,
+                # assume it hasn't changed rather than fetching it.
+                svg_fpath = find_svg_fpath(name, style, options)
+                svg_mtimes[(name, style)] = os.stat(svg_fpath).st_mtime if svg_fpath is not None else None
+            svg_mtime = svg_mtimes[(name, style)]
+            if svg_mtime is not None:
+                for fname in pngs_to_check:
+                    if entries[fname].stat().st_mtime < svg_mtime:
+                        pngs_to_create.add(fname)
         # Do the work.
         for fname in sorted(pngs_to_delete):
             fpath = os.path.join(dpath, fname)
-            sys.stdout.write("♻️  Deleting 🏞️  %s\n" % fpath)
+            log.append("♻️  Deleting 🏞️  %s\n" % fpath)
             if not flags["--dry-run"]:
                 os.remove(fpath)
+        resolutions = {fname1x: size, fname2x: size * 2, fname3x: size * 3}
         for fname in sorted(pngs_to_create):
-            fpath = os.path.join(dpath, fname)
-            rasterize(name, size, style, fpath, options)
-        make_imageset_contents_json(dpath, [fname1x, fname2x, fname3x])
+            pending_jobs.append((name, style, resolutions[fname], os.path.join(dpath, fname)))
+        make_imageset_contents_json(dpath, [fname1x, fname2x, fname3x], "Contents.json" in entries, log)
+    sys.stdout.write("".join(log))
+    # Start fetching the missing SVG's, and rasterize as they arrive.
+    name_style_pairs = set([(name, style) for (name, style, resolution, fpath) in pending_jobs])
+    (more_svg_fpaths, fetches) = locate_svgs(name_style_pairs.difference(svg_fpaths.keys()), options)
+    svg_fpaths.update(more_svg_fpaths)
+    jobs = []
+    for (name, style, resolution, fpath) in pending_jobs:
+        jobs.append((name, style, resolution, svg_fpaths[(name, style)], fpath))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as fetch_executor:
+        fetch_futures = start_svg_fetches(fetches, fetch_executor)
+        try:
+            rasterize_all(jobs, fetch_futures, options)
+        except BaseException:
+            # Stop at the first error, rather than running every queued fetch on shutdown.
+            fetch_executor.shutdown(wait=False, cancel_futures=True)
+            raise
     make_swift_file(catalog_dpath, options, icons_set)
 
 
 # Load and process a JSON config file.
 def process_catalog_fpath(catalog_fpath):
     config = load_catalog_fpath(catalog_fpath)
-    options = parse_options(config, catalog_fpath)
-    icons_set = parse_icon_groups(config, catalog_fpath)
+    (options, icons_set) = parse_config(config, catalog_fpath)
     # Replace the .json suffix with .xcassets.
     catalog_dpath = catalog_fpath[:-(len(".json"))] + ".xcassets"
     update_asset_catalog(catalog_dpath, icons_set, options)
@@ -430,7 +1027,11 @@ def usage(fd):
     if fd != sys.stderr:
         fd.write("phosphor-uikit.py: generate PNG-based asset catalogs.\n")
     fd.write("Usage:\n")
-    fd.write("  phosphor-uikit.py [--dry-run] config1.json config2.json ...\n")
+    fd.write("  phosphor-uikit.py [--dry-run] [--refresh] config1.json config2.json ...\n")
+    if fd != sys.stderr:
+        fd.write("Options:\n")
+        fd.write("  --dry-run: print what would be done, without doing it.\n")
+        fd.write("  --refresh: re-fetch cached SVG files which have changed on github.\n")
 
 
 if __name__ == "__main__":
@@ -439,6 +1040,8 @@ if __name__ == "__main__":
     for word in sys.argv[1:]:
         if word == "--dry-run":
             flags["--dry-run"] = True
+        elif word == "--refresh":
+            flags["--refresh"] = True
         elif word == "--help":
             usage(sys.stdout)
             sys.exit(0)
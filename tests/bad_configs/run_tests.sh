@@ -10,3 +10,4 @@
 ../../phosphor-uikit.py float-size.json
 ../../phosphor-uikit.py unexpected-array.json
 ../../phosphor-uikit.py unexpected-dict.json
+../../phosphor-uikit.py bad-downsample.json
@@ -0,0 +1,49 @@
+#!/bin/bash
+
+# two icons with byte-identical SVG's share their PNG cache entries,
+# so each resolution should only be rendered once.
+
+set -e
+
+script=$(cd ../.. && pwd)/phosphor-uikit.py
+work=$(mktemp -d)
+trap 'rm -rf "$work"' EXIT
+
+mkdir -p "$work/phosphor-core/assets/regular" "$work/bin"
+for name in star sparkle; do
+    echo '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 256 256"/>' > "$work/phosphor-core/assets/regular/$name.svg"
+done
+
+# a stand-in for rsvg-convert which logs each render.
+cat > "$work/bin/rsvg-convert" <<'EOS'
+#!/bin/bash
+for arg in "$@"; do
+    case "$arg" in
+        --output=*) output="${arg#--output=}" ;;
+    esac
+done
+sleep 0.1
+echo "$@" >> "$(dirname "$0")/renders.log"
+echo png > "$output"
+EOS
+chmod +x "$work/bin/rsvg-convert"
+
+echo "[{\"phosphor_core_path\": \"$work/phosphor-core\"}, [\"star\", \"sparkle\", 44, \"regular\"]]" > "$work/Icons.json"
+HOME="$work" PATH="$work/bin:$PATH" "$script" "$work/Icons.json" > /dev/null
+
+renders=$(wc -l < "$work/bin/renders.log")
+if [ "$renders" -ne 3 ]; then
+    echo "❌ expected 3 renders, got $renders"
+    exit 1
+fi
+for fname in star.44.regular.imageset/star.44.regular.png sparkle.44.regular.imageset/sparkle.44.regular@3x.png; do
+    if [ ! -f "$work/Icons.xcassets/$fname" ]; then
+        echo "❌ missing $fname"
+        exit 1
+    fi
+done
+if [ -n "$(find "$work" -name '*.tmp*')" ]; then
+    echo "❌ temporary files were left behind"
+    exit 1
+fi
+echo "✅ identical SVG's were rendered once"